@@ -1,28 +1,56 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import FastAPI, File, UploadFile, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import FileResponse, Response, ORJSONResponse
 import os
 import uuid
-import shutil
+from urllib.parse import quote
 from pathlib import Path
-import json
-from typing import Dict, Optional
+import orjson
+import hashlib
+import io
+import copy
+import re
+from xml.sax.saxutils import escape
+from typing import Optional
 import tempfile
-import moviepy.editor as mp
-from openai import OpenAI
+import time
+import threading
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import aiofiles
+import msgpack
+from openai import AsyncOpenAI
+import httpx
 from pptx import Presentation
 from pptx.util import Inches, Pt
 from pptx.dml.color import RGBColor
 from pptx.enum.text import PP_ALIGN
 from pptx.enum.dml import MSO_THEME_COLOR
 from pptx.enum.shapes import MSO_SHAPE
-import whisper
+from pptx.oxml import parse_xml
+from pptx.oxml.ns import qn
+from pptx.oxml.xmlchemy import OxmlElement
+from pptx.text.text import Font
+from faster_whisper import WhisperModel
+from faster_whisper.audio import pad_or_trim
+from faster_whisper.tokenizer import Tokenizer
+from faster_whisper.transcribe import get_suppressed_tokens, restore_speech_timestamps
+from faster_whisper.vad import VadOptions, get_speech_timestamps, merge_segments
+import numpy as np
+import torch
+from redis.asyncio import Redis
+from taskiq_redis import ListQueueBroker
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
 
-app = FastAPI(title="Voice-to-Slide Generator", version="1.0.0")
+app = FastAPI(
+    title="Voice-to-Slide Generator",
+    version="1.0.0",
+    default_response_class=ORJSONResponse
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -32,20 +60,150 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# In-memory job tracking
-jobs: Dict[str, dict] = {}
+class APIGZipMiddleware(GZipMiddleware):
+    """Gzip API responses but leave .pptx downloads (already zip-compressed) untouched"""
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].startswith("/download/"):
+            await self.app(scope, receive, send)
+            return
+        
+        await super().__call__(scope, receive, send)
+
+app.add_middleware(APIGZipMiddleware, minimum_size=500)
+
+# Redis holds job state and the task queue shared by the API and workers
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
+redis_client = Redis.from_url(REDIS_URL)
+broker = ListQueueBroker(url=REDIS_URL)
+
+# Whisper settings (CTranslate2 backend with INT8 quantized weights)
+WHISPER_DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+WHISPER_MODEL_SIZE = os.getenv(
+    "WHISPER_MODEL_SIZE",
+    "large-v3-turbo" if WHISPER_DEVICE == "cuda" else "base"
+)
+CPU_COUNT = os.cpu_count() or 1
+TRANSCRIBE_WORKERS = min(CPU_COUNT, 4)
 
-# Load Whisper model
-whisper_model = whisper.load_model("base")
+# On CPU, split audio into chunks of up to 30s and transcribe them concurrently.
+# CTranslate2 releases the GIL, so threads share one model in parallel.
+SAMPLE_RATE = 16000
+CHUNK_SECONDS = 30
+transcribe_executor = ThreadPoolExecutor(max_workers=TRANSCRIBE_WORKERS)
+
+# Silero VAD drops silence before decoding and places chunk boundaries at pauses
+VAD_OPTIONS = VadOptions(min_silence_duration_ms=500, max_speech_duration_s=CHUNK_SECONDS)
+
+# On GPU, 30s chunks from every job running in this worker are pooled for a
+# few milliseconds and decoded together in one encoder/decoder pass
+WHISPER_BATCH_SIZE = 24
+GPU_BATCH_MAX_WAIT_MS = 20
+NO_SPEECH_THRESHOLD = 0.6
+LOG_PROB_THRESHOLD = -1.0
+LENGTH_PENALTY = 1
+gpu_chunk_queue: Optional[asyncio.Queue] = None
+gpu_batch_task: Optional[asyncio.Task] = None
+
+# ffmpeg binary used for audio extraction
+FFMPEG_BINARY = os.getenv("FFMPEG_BINARY", "ffmpeg")
+
+# Initialize async OpenAI client with a pooled HTTP connection
+client = AsyncOpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    http_client=httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50)
+    )
+)
 
-# Initialize OpenAI client
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Slide outlines are cached by transcript, prompt version and model.
+# Bump SLIDES_PROMPT_VERSION whenever the prompt or sampling settings change.
+SLIDES_MODEL = "gpt-4o-mini"
+SLIDES_PROMPT_VERSION = "v4"
+SLIDES_CACHE_TTL_SECONDS = 24 * 60 * 60
+SLIDES_MAX_TOKENS = 800
+
+# Static instructions come first so OpenAI can reuse the cached prompt prefix
+SLIDES_PROMPT_PREFIX = """Convert the following transcript into a well-structured PowerPoint presentation outline.
+Create 5-8 slides with clear titles and bullet points.
+Call emit_slides with the presentation title and slides.
+
+Transcript: """
+
+# Strict mode makes the model's decoder follow this schema, so the tool
+# arguments always parse into the outline shape build_presentation expects
+SLIDES_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "emit_slides",
+        "description": "Emit the presentation outline",
+        "strict": True,
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "title": {"type": "string"},
+                "slides": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "title": {"type": "string"},
+                            "content": {"type": "array", "items": {"type": "string"}}
+                        },
+                        "required": ["title", "content"],
+                        "additionalProperties": False
+                    }
+                }
+            },
+            "required": ["title", "slides"],
+            "additionalProperties": False
+        }
+    }
+}
+
+# Loaded lazily; the lock keeps concurrent chunk threads from each loading a copy
+whisper_model: Optional[WhisperModel] = None
+whisper_model_lock = threading.Lock()
+
+def load_whisper_model():
+    """Load the Whisper model on first use so only worker processes pay for it"""
+    
+    global whisper_model
+    
+    if whisper_model is None:
+        with whisper_model_lock:
+            if whisper_model is None:
+                whisper_model = WhisperModel(
+                    WHISPER_MODEL_SIZE,
+                    device=WHISPER_DEVICE,
+                    compute_type="int8_float16" if WHISPER_DEVICE == "cuda" else "int8",
+                    cpu_threads=max(1, CPU_COUNT // TRANSCRIBE_WORKERS),
+                    num_workers=TRANSCRIBE_WORKERS
+                )
+    
+    return whisper_model
 
 # Create temp directories
 UPLOAD_DIR = Path("backend/temp/uploads")
 OUTPUT_DIR = Path("backend/temp/outputs")
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# Generated presentations, and uploads that were never transcribed, are kept
+# for a day, then swept from OUTPUT_DIR and UPLOAD_DIR
+OUTPUT_MAX_AGE_SECONDS = 24 * 60 * 60
+OUTPUT_SWEEP_INTERVAL_SECONDS = 60 * 60
+
+# Job hashes expire along with the presentation they point at
+JOB_TTL_SECONDS = OUTPUT_MAX_AGE_SECONDS
+
+# Downloads are revalidated on every request since regenerating slides
+# overwrites the file at the same URL; behind nginx, set NGINX_DOWNLOAD_PREFIX to an
+# internal location aliasing OUTPUT_DIR so nginx serves the file itself
+PPTX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.presentationml.presentation"
+DOWNLOAD_CACHE_CONTROL = "private, no-cache"
+NGINX_DOWNLOAD_PREFIX = os.getenv("NGINX_DOWNLOAD_PREFIX")
 
 # Define color themes for professional presentations
 COLOR_THEMES = {
@@ -87,30 +245,20 @@ COLOR_THEMES = {
     }
 }
 
-def apply_slide_theme(slide, theme_colors, is_title_slide=False):
-    """Apply theme colors and styling to a slide"""
-    
-    # Set slide background
-    background = slide.background
-    fill = background.fill
-    fill.solid()
-    fill.fore_color.rgb = theme_colors["background"]
-    
-    # Style title
-    if slide.shapes.title:
-        title_frame = slide.shapes.title.text_frame
-        title_frame.clear()
-        title_para = title_frame.paragraphs[0]
-        title_para.alignment = PP_ALIGN.CENTER if is_title_slide else PP_ALIGN.LEFT
-        
-        # Set title font properties
-        title_font = title_para.font
-        title_font.name = "Calibri"
-        title_font.size = Pt(36) if is_title_slide else Pt(28)
-        title_font.bold = True
-        title_font.color.rgb = theme_colors["primary"]
-    
-    return slide
+# Theme colors as hex strings for the frontend, computed once
+THEME_HEX = {
+    theme_id: {
+        "name": theme_data["name"],
+        "colors": {
+            color: "#{:02x}{:02x}{:02x}".format(*theme_data[color])
+            for color in ("primary", "secondary", "accent", "background")
+        }
+    }
+    for theme_id, theme_data in COLOR_THEMES.items()
+}
+
+# Shared point sizes used when styling slides
+POINT_SIZES = {size: Pt(size) for size in (2, 6, 10, 12, 18, 28, 36)}
 
 def style_content_text(content_shape, theme_colors, content_text):
     """Style content text with professional formatting"""
@@ -125,7 +273,7 @@ def style_content_text(content_shape, theme_colors, content_text):
     # Set font properties
     font = para.font
     font.name = "Calibri"
-    font.size = Pt(18)
+    font.size = POINT_SIZES[18]
     font.color.rgb = theme_colors["text"]
     
     # Add content text
@@ -157,7 +305,7 @@ def add_slide_footer(slide, slide_number, total_slides, theme_colors, presentati
     # Style slide number
     slide_num_font = slide_num_para.font
     slide_num_font.name = "Calibri"
-    slide_num_font.size = Pt(12)
+    slide_num_font.size = POINT_SIZES[12]
     slide_num_font.color.rgb = theme_colors["light_text"]
     
     # Add presentation title in bottom left (except for title slide)
@@ -177,7 +325,7 @@ def add_slide_footer(slide, slide_number, total_slides, theme_colors, presentati
         # Style footer title
         title_font = title_para.font
         title_font.name = "Calibri"
-        title_font.size = Pt(10)
+        title_font.size = POINT_SIZES[10]
         title_font.color.rgb = theme_colors["light_text"]
     
     return slide
@@ -198,7 +346,7 @@ def add_decorative_elements(slide, theme_colors, is_title_slide=False):
         # Style the line
         line = line_shape.line
         line.color.rgb = theme_colors["accent"]
-        line.width = Pt(2)
+        line.width = POINT_SIZES[2]
     
     else:
         # Add decorative accent shape for title slide
@@ -220,248 +368,644 @@ def add_decorative_elements(slide, theme_colors, is_title_slide=False):
     
     return slide
 
-@app.post("/upload")
-async def upload_file(file: UploadFile = File(...)):
-    if not file.filename.endswith('.mp4'):
-        raise HTTPException(status_code=400, detail="Only MP4 files are supported")
+def style_text_level(list_style, theme_color, size, bold=False, alignment=None, space_after=None):
+    """Set the default level-1 text style of a master text style or placeholder list style"""
+    
+    lvl1_ppr = list_style.find(qn("a:lvl1pPr"))
+    if lvl1_ppr is None:
+        lvl1_ppr = OxmlElement("a:lvl1pPr")
+        list_style.insert(0, lvl1_ppr)
+    
+    if alignment:
+        lvl1_ppr.set("algn", alignment)
+    
+    if space_after is not None:
+        spc_aft = OxmlElement("a:spcAft")
+        spc_pts = OxmlElement("a:spcPts")
+        spc_pts.set("val", str(int(space_after.pt * 100)))
+        spc_aft.append(spc_pts)
+        spc_bef = lvl1_ppr.find(qn("a:spcBef"))
+        if spc_bef is not None:
+            spc_bef.addnext(spc_aft)
+        else:
+            lvl1_ppr.insert(0, spc_aft)
+    
+    def_rpr = lvl1_ppr.find(qn("a:defRPr"))
+    if def_rpr is None:
+        def_rpr = OxmlElement("a:defRPr")
+        lvl1_ppr.append(def_rpr)
+    
+    font = Font(def_rpr)
+    font.name = "Calibri"
+    font.size = size
+    font.bold = bold
+    font.color.rgb = theme_color
+
+def build_theme_template(theme_colors):
+    """Build a blank presentation whose slide master and layouts carry a theme's styling"""
     
-    job_id = str(uuid.uuid4())
-    file_path = UPLOAD_DIR / f"{job_id}.mp4"
+    prs = Presentation()
+    master = prs.slide_master
+    title_layout = prs.slide_layouts[0]
+    content_layout = prs.slide_layouts[1]
+    
+    # Background on the master is inherited by every layout and slide
+    fill = master.background.fill
+    fill.solid()
+    fill.fore_color.rgb = theme_colors["background"]
     
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    # Default title and bullet text styles
+    text_styles = master._element.find(qn("p:txStyles"))
+    style_text_level(text_styles.find(qn("p:titleStyle")), theme_colors["primary"], POINT_SIZES[28], bold=True, alignment="l")
+    style_text_level(text_styles.find(qn("p:bodyStyle")), theme_colors["text"], POINT_SIZES[18], space_after=POINT_SIZES[6])
+    
+    # Title slide: large centered title and a muted subtitle
+    title_list_style = title_layout.placeholders[0]._element.txBody.find(qn("a:lstStyle"))
+    style_text_level(title_list_style, theme_colors["primary"], POINT_SIZES[36], bold=True, alignment="ctr")
+    subtitle_list_style = title_layout.placeholders[1]._element.txBody.find(qn("a:lstStyle"))
+    style_text_level(subtitle_list_style, theme_colors["light_text"], POINT_SIZES[18], alignment="ctr")
+    
+    # Draw the decorative elements on scratch slides and move them into the layouts
+    scratch = Presentation()
+    for layout, is_title_slide in ((title_layout, True), (content_layout, False)):
+        scratch_slide = scratch.slides.add_slide(scratch.slide_layouts[6])
+        add_decorative_elements(scratch_slide, theme_colors, is_title_slide=is_title_slide)
+        for shape in scratch_slide.shapes:
+            element = copy.deepcopy(shape._element)
+            element[0].find(qn("p:cNvPr")).set("id", str(layout.shapes._next_shape_id))
+            layout.shapes._spTree.append(element)
+    
+    template = io.BytesIO()
+    prs.save(template)
+    return template.getvalue()
+
+# Themed templates are built once; each request only loads one and fills in text
+THEME_TEMPLATES = {
+    theme_id: build_theme_template(theme_colors)
+    for theme_id, theme_colors in COLOR_THEMES.items()
+}
+
+# Content slide shape tree (title, bullets and footer), filled in with str.format
+CONTENT_SLIDE_XML = (Path(__file__).parent / "slide_template.xml").read_text()
+BULLET_XML = '<a:p><a:r><a:t>{text}</a:t></a:r></a:p>'
+INVALID_XML_CHARS = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+def xml_text(value):
+    """Escape a string for use as XML text content"""
     
-    jobs[job_id] = {
-        "status": "uploaded",
-        "filename": file.filename,
-        "file_path": str(file_path),
-        "progress": 10
-    }
+    return escape(INVALID_XML_CHARS.sub("", str(value)))
+
+def build_content_slide_xml(slide_data, slide_number, total_slides, theme_colors, presentation_title):
+    """Render a content slide's shape tree from the XML template"""
+    
+    footer_title = presentation_title[:50] + "..." if len(presentation_title) > 50 else presentation_title
+    bullets = "".join(BULLET_XML.format(text=xml_text(f"• {point}")) for point in slide_data["content"])
+    
+    return CONTENT_SLIDE_XML.format(
+        title=xml_text(slide_data["title"]),
+        bullets=bullets or "<a:p/>",
+        slide_number=slide_number,
+        total_slides=total_slides,
+        footer_title=xml_text(footer_title),
+        light_text=str(theme_colors["light_text"])
+    )
+
+async def extract_audio(video_path):
+    """Decode a video's audio track with ffmpeg into 16kHz mono float32 samples"""
+    
+    # ffmpeg downmixes and resamples, then streams raw samples over stdout, so no WAV is written
+    process = await asyncio.create_subprocess_exec(
+        FFMPEG_BINARY, "-nostdin", "-i", str(video_path),
+        "-vn", "-ac", "1", "-ar", str(SAMPLE_RATE), "-f", "f32le", "-",
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    stdout, stderr = await process.communicate()
     
-    print(f"File uploaded: {file.filename} -> {job_id}")
-    return {"job_id": job_id, "message": "File uploaded successfully"}
+    if process.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed: {stderr.decode(errors='replace').strip()[-500:]}")
+    
+    return np.frombuffer(stdout, dtype=np.float32)
 
-@app.get("/status/{job_id}")
-async def get_status(job_id: str):
-    if job_id not in jobs:
-        raise HTTPException(status_code=404, detail="Job not found")
+def transcribe_samples(samples, speech_spans):
+    """Transcribe a chunk's concatenated speech into segments timed from the start of the file"""
     
-    return jobs[job_id]
+    segments, info = load_whisper_model().transcribe(
+        samples, beam_size=1, condition_on_previous_text=False
+    )
+    
+    # Timestamps are relative to the speech-only samples, so add back the cut silence
+    return [
+        {
+            "start": round(segment.start, 2),
+            "end": round(segment.end, 2),
+            "text": segment.text
+        }
+        for segment in restore_speech_timestamps(segments, speech_spans, SAMPLE_RATE)
+    ]
 
-@app.get("/transcript/{job_id}")
-async def get_transcript(job_id: str):
-    if job_id not in jobs:
-        raise HTTPException(status_code=404, detail="Job not found")
+def find_speech_chunks(audio):
+    """Return chunks of speech spans in samples, each chunk spanning at most CHUNK_SECONDS"""
+    
+    speech = get_speech_timestamps(audio, VAD_OPTIONS)
+    return [
+        [{"start": start, "end": end} for start, end in clip["segments"]]
+        for clip in merge_segments(speech, VAD_OPTIONS)
+    ]
+
+def collect_speech(audio, speech_spans):
+    """Concatenate a chunk's speech spans, leaving out the silence between them"""
     
-    job = jobs[job_id]
+    return np.concatenate([audio[span["start"]:span["end"]] for span in speech_spans])
+
+def transcribe_chunk_batch(chunks):
+    """Decode a batch of 30s chunks, possibly from different jobs, in one GPU pass"""
+    
+    whisper_model = load_whisper_model()
+    features = np.stack([
+        pad_or_trim(whisper_model.feature_extractor(chunk)[..., :-1]) for chunk in chunks
+    ])
+    encoder_output = whisper_model.encode(features)
+    
+    # Chunks can come from different uploads, so detect each one's language
+    if whisper_model.model.is_multilingual:
+        languages = [
+            language_probs[0][0][2:-2]
+            for language_probs in whisper_model.model.detect_language(encoder_output)
+        ]
+    else:
+        languages = ["en"] * len(chunks)
+    
+    tokenizers = [
+        Tokenizer(whisper_model.hf_tokenizer, whisper_model.model.is_multilingual, task="transcribe", language=language)
+        for language in languages
+    ]
+    
+    results = whisper_model.model.generate(
+        encoder_output,
+        [whisper_model.get_prompt(tokenizer, [], without_timestamps=True) for tokenizer in tokenizers],
+        beam_size=1,
+        max_length=whisper_model.max_length,
+        suppress_blank=True,
+        suppress_tokens=get_suppressed_tokens(tokenizers[0], [-1]),
+        length_penalty=LENGTH_PENALTY,
+        return_scores=True,
+        return_no_speech_prob=True
+    )
     
-    if job["status"] == "uploaded":
-        # Extract audio
-        jobs[job_id]["status"] = "extracting_audio"
-        jobs[job_id]["progress"] = 20
+    # Like faster-whisper, drop a chunk as silence only if it also decoded with low confidence
+    texts = []
+    for tokenizer, result in zip(tokenizers, results):
+        seq_len = len(result.sequences_ids[0])
+        avg_logprob = result.scores[0] * (seq_len**LENGTH_PENALTY) / (seq_len + 1)
+        
+        if result.no_speech_prob > NO_SPEECH_THRESHOLD and avg_logprob <= LOG_PROB_THRESHOLD:
+            texts.append("")
+        else:
+            texts.append(tokenizer.decode(result.sequences_ids[0]))
+    
+    return texts
+
+async def run_gpu_batches(queue):
+    """Collect queued chunks for up to GPU_BATCH_MAX_WAIT_MS, then decode them as one batch"""
+    
+    loop = asyncio.get_running_loop()
+    
+    while True:
+        batch = [await queue.get()]
+        deadline = loop.time() + GPU_BATCH_MAX_WAIT_MS / 1000
+        
+        while len(batch) < WHISPER_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
         
+        chunks = [chunk for chunk, _ in batch]
         try:
-            video_path = job["file_path"]
-            audio_path = UPLOAD_DIR / f"{job_id}.wav"
-            
-            video = mp.VideoFileClip(video_path)
-            video.audio.write_audiofile(str(audio_path), verbose=False, logger=None)
-            video.close()
-            
-            jobs[job_id]["status"] = "transcribing"
-            jobs[job_id]["progress"] = 40
-            jobs[job_id]["audio_path"] = str(audio_path)
-            
-            # Transcribe audio
-            result = whisper_model.transcribe(str(audio_path))
-            transcript = result["text"]
-            
-            jobs[job_id]["status"] = "transcript_ready"
-            jobs[job_id]["progress"] = 60
-            jobs[job_id]["transcript"] = transcript
-            
-            print(f"Transcription completed for job {job_id}")
-            
+            texts = await loop.run_in_executor(transcribe_executor, transcribe_chunk_batch, chunks)
         except Exception as e:
-            jobs[job_id]["status"] = "error"
-            jobs[job_id]["error"] = str(e)
-            print(f"Error processing {job_id}: {str(e)}")
-            raise HTTPException(status_code=500, detail=str(e))
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            continue
+        
+        for (_, future), text in zip(batch, texts):
+            if not future.done():
+                future.set_result(text)
+
+async def transcribe_chunk_on_gpu(chunk):
+    """Add a chunk to the shared GPU batch and wait for its text"""
     
-    if "transcript" in jobs[job_id]:
-        return {"transcript": jobs[job_id]["transcript"]}
-    else:
-        return {"message": "Transcript not ready yet"}
+    global gpu_chunk_queue, gpu_batch_task
+    
+    # Start the batching loop on first use inside this worker's event loop
+    if gpu_batch_task is None or gpu_batch_task.done():
+        gpu_chunk_queue = asyncio.Queue()
+        gpu_batch_task = asyncio.create_task(run_gpu_batches(gpu_chunk_queue))
+    
+    future = asyncio.get_running_loop().create_future()
+    await gpu_chunk_queue.put((chunk, future))
+    
+    return await future
 
-@app.post("/generate-slides/{job_id}")
-async def generate_slides(job_id: str, theme: str = "corporate_blue"):
-    if job_id not in jobs:
-        raise HTTPException(status_code=404, detail="Job not found")
+async def transcribe_audio(audio):
+    """Transcribe the speech in 16kHz mono samples, in parallel on CPU or batched on GPU"""
+    
+    loop = asyncio.get_running_loop()
+    chunks = await loop.run_in_executor(transcribe_executor, find_speech_chunks, audio)
+    
+    if WHISPER_DEVICE == "cuda":
+        texts = await asyncio.gather(*[
+            transcribe_chunk_on_gpu(collect_speech(audio, speech_spans)) for speech_spans in chunks
+        ])
+        return [
+            {
+                "start": round(speech_spans[0]["start"] / SAMPLE_RATE, 2),
+                "end": round(speech_spans[-1]["end"] / SAMPLE_RATE, 2),
+                "text": text
+            }
+            for speech_spans, text in zip(chunks, texts)
+            if text.strip()
+        ]
+    
+    chunk_results = await asyncio.gather(*[
+        loop.run_in_executor(
+            transcribe_executor,
+            transcribe_samples,
+            collect_speech(audio, speech_spans),
+            speech_spans
+        )
+        for speech_spans in chunks
+    ])
     
-    job = jobs[job_id]
+    return [segment for chunk_segments in chunk_results for segment in chunk_segments]
+
+async def get_job(job_id: str) -> Optional[dict]:
+    """Load a job's state from its Redis hash"""
     
-    if "transcript" not in job:
-        raise HTTPException(status_code=400, detail="Transcript not available")
+    fields = await redis_client.hgetall(f"job:{job_id}")
+    if not fields:
+        return None
+    
+    return {key.decode(): msgpack.unpackb(value) for key, value in fields.items()}
+
+async def get_job_fields(job_id: str, *fields) -> list:
+    """Load selected fields of a job's Redis hash, with None for missing ones"""
+    
+    values = await redis_client.hmget(f"job:{job_id}", fields)
+    return [msgpack.unpackb(value) if value is not None else None for value in values]
+
+async def update_job(job_id: str, **fields):
+    """Set fields on a job's Redis hash, leaving the others untouched, and refresh its TTL"""
+    
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hset(
+            f"job:{job_id}",
+            mapping={key: msgpack.packb(value) for key, value in fields.items()}
+        )
+        pipe.expire(f"job:{job_id}", JOB_TTL_SECONDS)
+        await pipe.execute()
+
+# Compare-and-set on a job's status: ARGV[1] is the TTL, ARGV[2] the count of
+# allowed current statuses, followed by those statuses and the field/value pairs to set
+TRANSITION_JOB_SCRIPT = redis_client.register_script("""
+local status = redis.call("HGET", KEYS[1], "status")
+local allowed = tonumber(ARGV[2])
+for i = 3, allowed + 2 do
+    if status == ARGV[i] then
+        redis.call("HSET", KEYS[1], unpack(ARGV, allowed + 3))
+        redis.call("EXPIRE", KEYS[1], ARGV[1])
+        return 1
+    end
+end
+return 0
+""")
+
+async def transition_job(job_id: str, from_statuses, **fields) -> bool:
+    """Atomically set fields on a job only if its status is one of from_statuses"""
+    
+    args = [JOB_TTL_SECONDS, len(from_statuses)] + [msgpack.packb(status) for status in from_statuses]
+    for key, value in fields.items():
+        args += [key, msgpack.packb(value)]
+    
+    return bool(await TRANSITION_JOB_SCRIPT(keys=[f"job:{job_id}"], args=args))
+
+async def generate_slide_content(transcript: str) -> dict:
+    """Ask OpenAI to turn a transcript into a slide outline"""
+    
+    response = await client.chat.completions.create(
+        model=SLIDES_MODEL,
+        messages=[{"role": "user", "content": SLIDES_PROMPT_PREFIX + transcript}],
+        max_tokens=SLIDES_MAX_TOKENS,
+        temperature=0.3,
+        tools=[SLIDES_TOOL],
+        tool_choice={"type": "function", "function": {"name": "emit_slides"}}
+    )
+    
+    # A truncated tool call carries half-written JSON, so fail with a readable error instead
+    choice = response.choices[0]
+    if choice.finish_reason == "length":
+        raise RuntimeError(f"Slide outline exceeded the {SLIDES_MAX_TOKENS}-token limit; try a shorter video")
+    
+    # Strict mode can answer with a refusal instead of calling emit_slides
+    if choice.message.refusal or not choice.message.tool_calls:
+        raise RuntimeError(f"Model did not return a slide outline: {choice.message.refusal or 'no tool call'}")
+    
+    return orjson.loads(choice.message.tool_calls[0].function.arguments)
+
+async def get_slide_content(transcript: str) -> dict:
+    """Return the slide outline for a transcript, checking the Redis cache first"""
+    
+    digest = hashlib.sha256(f"{transcript}{SLIDES_PROMPT_VERSION}{SLIDES_MODEL}".encode()).hexdigest()
+    cache_key = f"slides:{digest}"
+    
+    cached = await redis_client.get(cache_key)
+    if cached:
+        print(f"Slide content cache hit: {digest[:12]}")
+        return orjson.loads(cached)
+    
+    slide_content = await generate_slide_content(transcript)
+    await redis_client.setex(cache_key, SLIDES_CACHE_TTL_SECONDS, orjson.dumps(slide_content))
+    
+    return slide_content
+
+def build_presentation(job_id: str, slide_content: dict, theme: str) -> Path:
+    """Render slide content to a themed .pptx file and return its path"""
+    
+    # Get selected theme colors and its prebuilt template
+    theme = theme if theme in COLOR_THEMES else "corporate_blue"
+    theme_colors = COLOR_THEMES[theme]
+    
+    # Create PowerPoint presentation from the themed template
+    prs = Presentation(io.BytesIO(THEME_TEMPLATES[theme]))
+    
+    # Calculate total slides
+    total_slides = len(slide_content["slides"]) + 1
+    presentation_title = slide_content["title"]
+    
+    # Title slide; background, fonts and accent bar come from the layout
+    title_slide = prs.slides.add_slide(prs.slide_layouts[0])
+    title_slide.shapes.title.text = presentation_title
+    title_slide.placeholders[1].text = "Generated from audio transcript"
+    title_slide = add_slide_footer(title_slide, 1, total_slides, theme_colors, presentation_title)
+    
+    # Content slides; background, fonts and accent line come from the layout, and the
+    # shape tree is swapped for one rendered from the XML template in a single parse
+    for slide_index, slide_data in enumerate(slide_content["slides"]):
+        slide = prs.slides.add_slide(prs.slide_layouts[1])
+        sp_tree = slide.shapes._spTree
+        sp_tree.getparent().replace(sp_tree, parse_xml(build_content_slide_xml(
+            slide_data, slide_index + 2, total_slides, theme_colors, presentation_title
+        )))
+    
+    # Save PowerPoint file
+    ppt_path = OUTPUT_DIR / f"{job_id}.pptx"
+    prs.save(str(ppt_path))
+    
+    return ppt_path
+
+def remove_file(path: str):
+    """Delete a file if it still exists"""
+    
+    if path:
+        Path(path).unlink(missing_ok=True)
+
+def sweep_temp_files():
+    """Delete presentations and leftover uploads older than OUTPUT_MAX_AGE_SECONDS"""
+    
+    cutoff = time.time() - OUTPUT_MAX_AGE_SECONDS
+    
+    # Uploads are normally removed by run_transcription, but one that was never
+    # transcribed outlives its expired job hash and would otherwise stay forever
+    for path in [*OUTPUT_DIR.glob("*.pptx"), *UPLOAD_DIR.glob("*.mp4")]:
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+        except FileNotFoundError:
+            pass
+
+async def sweep_temp_files_periodically():
+    """Run sweep_temp_files every OUTPUT_SWEEP_INTERVAL_SECONDS"""
+    
+    while True:
+        try:
+            await asyncio.to_thread(sweep_temp_files)
+        except Exception as e:
+            print(f"Error sweeping temp files: {str(e)}")
+        await asyncio.sleep(OUTPUT_SWEEP_INTERVAL_SECONDS)
+
+@broker.task
+async def run_transcription(job_id: str):
+    """Extract audio from an uploaded video and transcribe it"""
+    
+    job = await get_job(job_id)
+    if job is None:
+        print(f"Job {job_id} not found, skipping")
+        return
     
     try:
-        jobs[job_id]["status"] = "generating_slides"
-        jobs[job_id]["progress"] = 70
+        # Extract audio
+        await update_job(job_id, status="extracting_audio", progress=20)
         
-        # Generate slide content using OpenAI
-        transcript = job["transcript"]
+        audio = await extract_audio(job["file_path"])
         
-        prompt = f"""
-        Convert the following transcript into a well-structured PowerPoint presentation outline.
-        Create 5-8 slides with clear titles and bullet points.
-        Format as JSON with this structure:
-        {{
-            "title": "Presentation Title",
-            "slides": [
-                {{
-                    "title": "Slide Title",
-                    "content": ["Bullet point 1", "Bullet point 2", "Bullet point 3"]
-                }}
-            ]
-        }}
+        # The decoded samples are all we need from the upload now
+        await asyncio.to_thread(remove_file, job["file_path"])
+        await update_job(job_id, status="transcribing", progress=40, file_path="")
         
-        Transcript: {transcript}
-        """
+        # Transcribe audio
+        segments = await transcribe_audio(audio)
+        transcript = "".join(segment["text"] for segment in segments).strip()
         
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=1500
+        await update_job(
+            job_id,
+            status="transcript_ready",
+            progress=60,
+            transcript=transcript,
+            segments=segments
         )
         
-        slide_content = json.loads(response.choices[0].message.content)
-        
-        jobs[job_id]["status"] = "creating_powerpoint"
-        jobs[job_id]["progress"] = 85
-        jobs[job_id]["slide_content"] = slide_content
-        
-        # Get selected theme colors
-        theme_colors = COLOR_THEMES.get(theme, COLOR_THEMES["corporate_blue"])
-        
-        # Create PowerPoint presentation
-        prs = Presentation()
-        
-        # Calculate total slides
-        total_slides = len(slide_content["slides"]) + 1
-        presentation_title = slide_content["title"]
+        print(f"Transcription completed for job {job_id}")
         
-        # Title slide with theme
-        title_slide = prs.slides.add_slide(prs.slide_layouts[0])
-        title_slide = apply_slide_theme(title_slide, theme_colors, is_title_slide=True)
-        
-        # Set title content
-        title_slide.shapes.title.text_frame.paragraphs[0].text = presentation_title
-        
-        # Set subtitle with theme styling
-        if title_slide.placeholders[1]:
-            subtitle_shape = title_slide.placeholders[1]
-            subtitle_shape.text_frame.clear()
-            subtitle_para = subtitle_shape.text_frame.paragraphs[0]
-            subtitle_para.text = "Generated from audio transcript"
-            subtitle_para.alignment = PP_ALIGN.CENTER
-            subtitle_font = subtitle_para.font
-            subtitle_font.name = "Calibri"
-            subtitle_font.size = Pt(18)
-            subtitle_font.color.rgb = theme_colors["light_text"]
+    except Exception as e:
+        await asyncio.to_thread(remove_file, job["file_path"])
+        await update_job(job_id, status="error", error=str(e))
+        print(f"Error processing {job_id}: {str(e)}")
+
+@broker.task
+async def run_slides(job_id: str, theme: str = "corporate_blue"):
+    """Generate slide content with OpenAI and render it to PowerPoint"""
+    
+    job = await get_job(job_id)
+    if job is None:
+        print(f"Job {job_id} not found, skipping")
+        return
+    
+    try:
+        await update_job(job_id, status="generating_slides", progress=70)
         
-        # Add decorative elements and footer to title slide
-        title_slide = add_decorative_elements(title_slide, theme_colors, is_title_slide=True)
-        title_slide = add_slide_footer(title_slide, 1, total_slides, theme_colors, presentation_title)
+        # Generate slide content using OpenAI, reusing cached results for repeat transcripts
+        slide_content = await get_slide_content(job["transcript"])
         
-        # Content slides with theme
-        for slide_index, slide_data in enumerate(slide_content["slides"]):
-            slide = prs.slides.add_slide(prs.slide_layouts[1])
-            slide = apply_slide_theme(slide, theme_colors, is_title_slide=False)
-            
-            # Set slide title
-            slide.shapes.title.text_frame.paragraphs[0].text = slide_data["title"]
-            
-            # Style content with better formatting
-            content_shape = slide.placeholders[1]
-            content_shape.text_frame.clear()
-            
-            # Add each bullet point as a separate paragraph for better formatting
-            for i, point in enumerate(slide_data["content"]):
-                if i == 0:
-                    para = content_shape.text_frame.paragraphs[0]
-                else:
-                    para = content_shape.text_frame.add_paragraph()
-                
-                para.text = f"• {point}"
-                para.level = 0
-                para.alignment = PP_ALIGN.LEFT
-                
-                # Style each bullet point
-                font = para.font
-                font.name = "Calibri"
-                font.size = Pt(18)
-                font.color.rgb = theme_colors["text"]
-                
-                # Add spacing between bullet points
-                para.space_after = Pt(6)
-            
-            # Add decorative elements and footer to content slide
-            slide = add_decorative_elements(slide, theme_colors, is_title_slide=False)
-            slide = add_slide_footer(slide, slide_index + 2, total_slides, theme_colors, presentation_title)
+        await update_job(job_id, status="creating_powerpoint", progress=85, slide_content=slide_content)
         
-        # Save PowerPoint file
-        ppt_path = OUTPUT_DIR / f"{job_id}.pptx"
-        prs.save(str(ppt_path))
+        # Create PowerPoint presentation off the event loop
+        ppt_path = await asyncio.to_thread(build_presentation, job_id, slide_content, theme)
         
-        jobs[job_id]["status"] = "completed"
-        jobs[job_id]["progress"] = 100
-        jobs[job_id]["ppt_path"] = str(ppt_path)
+        await update_job(job_id, status="completed", progress=100, ppt_path=str(ppt_path))
         
         print(f"PowerPoint generated for job {job_id}")
         
-        return {"message": "Slides generated successfully", "slide_content": slide_content}
-        
     except Exception as e:
-        jobs[job_id]["status"] = "error"
-        jobs[job_id]["error"] = str(e)
+        await update_job(job_id, status="error", error=str(e))
         print(f"Error generating slides for {job_id}: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/download/{job_id}")
-async def download_file(job_id: str):
-    if job_id not in jobs:
+@app.on_event("startup")
+async def startup():
+    if not broker.is_worker_process:
+        await broker.startup()
+    app.state.sweeper = asyncio.create_task(sweep_temp_files_periodically())
+
+@app.on_event("shutdown")
+async def shutdown():
+    app.state.sweeper.cancel()
+    if not broker.is_worker_process:
+        await broker.shutdown()
+    await redis_client.aclose()
+    await client.close()
+
+@app.post("/upload")
+async def upload_file(file: UploadFile = File(...)):
+    if not file.filename.endswith('.mp4'):
+        raise HTTPException(status_code=400, detail="Only MP4 files are supported")
+    
+    job_id = str(uuid.uuid4())
+    file_path = UPLOAD_DIR / f"{job_id}.mp4"
+    
+    # Stream the upload to disk in 1MB chunks without blocking the event loop
+    async with aiofiles.open(file_path, "wb") as buffer:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            await buffer.write(chunk)
+    
+    await update_job(
+        job_id,
+        status="uploaded",
+        filename=file.filename,
+        file_path=str(file_path),
+        progress=10
+    )
+    
+    print(f"File uploaded: {file.filename} -> {job_id}")
+    return {"job_id": job_id, "message": "File uploaded successfully"}
+
+@app.get("/status/{job_id}")
+async def get_status(job_id: str):
+    # Polled frequently, so only load the small fields; the transcript has its own endpoint
+    status, progress, error = await get_job_fields(job_id, "status", "progress", "error")
+    if status is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    result = {"status": status, "progress": progress}
+    if error is not None:
+        result["error"] = error
+    
+    return result
+
+@app.get("/transcript/{job_id}")
+async def get_transcript(job_id: str):
+    job = await get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    # Only the request that moves the job out of "uploaded" enqueues it
+    if job["status"] == "uploaded" and await transition_job(job_id, ["uploaded"], status="queued", progress=15):
+        # Hand extraction and transcription to a worker
+        await run_transcription.kiq(job_id)
+        return {"status": "queued"}
+    
+    if "transcript" in job:
+        return {"transcript": job["transcript"]}
+    else:
+        return {"message": "Transcript not ready yet"}
+
+@app.post("/generate-slides/{job_id}")
+async def generate_slides(job_id: str, theme: str = "corporate_blue"):
+    job = await get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    if "transcript" not in job:
+        raise HTTPException(status_code=400, detail="Transcript not available")
+    
+    if not await transition_job(job_id, ["transcript_ready", "completed", "error"], status="queued", progress=65):
+        raise HTTPException(status_code=409, detail="Slides are already being generated")
+    
+    await run_slides.kiq(job_id, theme)
+    
+    return {"status": "queued"}
+
+@app.get("/slides/{job_id}")
+async def get_slides(job_id: str):
+    job = await get_job(job_id)
+    if job is None:
         raise HTTPException(status_code=404, detail="Job not found")
     
-    job = jobs[job_id]
+    if "slide_content" not in job:
+        raise HTTPException(status_code=400, detail="Slides not ready")
+    
+    return {"slide_content": job["slide_content"]}
+
+@app.get("/download/{job_id}")
+async def download_file(job_id: str, request: Request):
+    job = await get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
     
     if job["status"] != "completed" or "ppt_path" not in job:
         raise HTTPException(status_code=400, detail="PowerPoint not ready")
     
     ppt_path = job["ppt_path"]
     
-    if not os.path.exists(ppt_path):
+    try:
+        stat_result = os.stat(ppt_path)
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="File not found")
     
+    headers = {
+        "ETag": f'"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"',
+        "Cache-Control": DOWNLOAD_CACHE_CONTROL
+    }
+    
+    # Client already has this version of the file (weak comparison, as for GET)
+    if_none_match = request.headers.get("if-none-match", "")
+    client_etags = {re.sub(r"^W/", "", etag.strip()) for etag in if_none_match.split(",")}
+    if headers["ETag"] in client_etags or "*" in client_etags:
+        return Response(status_code=304, headers=headers)
+    
+    filename = f"{job['filename']}.pptx"
+    
+    # Let nginx stream the file with sendfile
+    if NGINX_DOWNLOAD_PREFIX:
+        headers["X-Accel-Redirect"] = f"{NGINX_DOWNLOAD_PREFIX.rstrip('/')}/{Path(ppt_path).name}"
+        headers["Content-Disposition"] = f"attachment; filename*=utf-8''{quote(filename)}"
+        return Response(headers=headers, media_type=PPTX_MEDIA_TYPE)
+    
     return FileResponse(
         path=ppt_path,
-        filename=f"{job['filename']}.pptx",
-        media_type="application/vnd.openxmlformats-officedocument.presentationml.presentation"
+        filename=filename,
+        media_type=PPTX_MEDIA_TYPE,
+        stat_result=stat_result,
+        headers=headers
     )
 
 @app.get("/themes")
 async def get_themes():
     """Get available presentation themes"""
-    themes = {}
-    for theme_id, theme_data in COLOR_THEMES.items():
-        themes[theme_id] = {
-            "name": theme_data["name"],
-            "colors": {
-                "primary": f"#{theme_data['primary'].r:02x}{theme_data['primary'].g:02x}{theme_data['primary'].b:02x}",
-                "secondary": f"#{theme_data['secondary'].r:02x}{theme_data['secondary'].g:02x}{theme_data['secondary'].b:02x}",
-                "accent": f"#{theme_data['accent'].r:02x}{theme_data['accent'].g:02x}{theme_data['accent'].b:02x}",
-                "background": f"#{theme_data['background'].r:02x}{theme_data['background'].g:02x}{theme_data['background'].b:02x}"
-            }
-        }
-    return {"themes": themes}
+    return {"themes": THEME_HEX}
 
 @app.get("/")
 async def root():
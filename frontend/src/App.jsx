@@ -94,11 +94,37 @@ function App() {
     }
   }
 
+  const waitForStatus = async (targetStatus) => {
+    // Poll until the background worker reaches the target status
+    while (true) {
+      await new Promise((resolve) => setTimeout(resolve, 2000))
+
+      const response = await axios.get(`${API_BASE_URL}/status/${jobId}`)
+      const jobStatus = response.data
+
+      setStatus(jobStatus.status)
+      setProgress(jobStatus.progress || 0)
+
+      if (jobStatus.status === 'error') {
+        throw new Error(jobStatus.error)
+      }
+      if (jobStatus.status === targetStatus) {
+        return jobStatus
+      }
+    }
+  }
+
   const getTranscript = async () => {
     if (!jobId) return
 
     try {
-      const response = await axios.get(`${API_BASE_URL}/transcript/${jobId}`)
+      let response = await axios.get(`${API_BASE_URL}/transcript/${jobId}`)
+
+      if (response.data.status === 'queued') {
+        setStatus('queued')
+        await waitForStatus('transcript_ready')
+        response = await axios.get(`${API_BASE_URL}/transcript/${jobId}`)
+      }
       
       if (response.data.transcript) {
         setTranscript(response.data.transcript)
@@ -117,7 +143,11 @@ function App() {
     if (!jobId) return
 
     try {
-      const response = await axios.post(`${API_BASE_URL}/generate-slides/${jobId}?theme=${selectedTheme}`)
+      await axios.post(`${API_BASE_URL}/generate-slides/${jobId}?theme=${selectedTheme}`)
+      setStatus('queued')
+      await waitForStatus('completed')
+
+      const response = await axios.get(`${API_BASE_URL}/slides/${jobId}`)
       
       setSlideContent(response.data.slide_content)
       setStatus('completed')